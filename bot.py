@@ -1,11 +1,11 @@
 from __future__ import annotations
-import asyncio, hashlib, html, logging, os, re, sqlite3, textwrap, certifi, feedparser, openai, requests
-from contextlib import contextmanager
-from datetime import UTC, datetime, timedelta
-from functools import partial
+import ahocorasick, aiohttp, aiosqlite, asyncio, hashlib, html, logging, os, re, ssl, textwrap, time, certifi, fastfeedparser, orjson
+from bisect import bisect_right
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import UTC, datetime
 from logging.handlers import RotatingFileHandler
-from typing import Any, Iterable, Sequence
-from bs4 import BeautifulSoup
+from typing import Any, AsyncIterator, Iterable, Sequence
 from dateutil import parser as dtparse
 from dotenv import load_dotenv
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
@@ -13,11 +13,14 @@ from telegram.constants import ParseMode
 from telegram.ext import AIORateLimiter, ApplicationBuilder, CallbackQueryHandler, CommandHandler, ContextTypes, JobQueue
 
 FEED_URL="https://www.contractsfinder.service.gov.uk/Published/Notices/Rss"
-DB_FILE,LOG_DIR,CACHE_DIR="bot.db","log","cache"
+OPENAI_URL="https://api.openai.com/v1/chat/completions"
+DB_FILE,LOG_DIR="bot.db","log"
 MAX_SUBS,FETCH_MIN,HTTP_RETRIES,HTTP_BACKOFF=5,10,3,2
-OPENAI_RETRIES,OPENAI_LIMIT,MSG_MAX=3,60,4096
+OPENAI_RETRIES,OPENAI_LIMIT,OPENAI_CONCURRENCY,MSG_MAX=3,60,8,4096
 VALID_KEYWORD=re.compile(r"^[A-Za-z0-9_-]{2,30}$")
-BOUND=lambda k:re.compile(rf"(?<![A-Za-z0-9_]){re.escape(k)}(?![A-Za-z0-9_])",re.IGNORECASE)
+STRIP_HTML=re.compile(r"<[^>]+>")
+BREAK_RE=re.compile(r"(?=\n\n|<p)")
+WORD_CH=frozenset("abcdefghijklmnopqrstuvwxyz0123456789_")
 UI={"welcome":"Welcome! Use /subscribe <kw> … /help","help":"/start /subscribe /unsubscribe /list /clear",
      "no_kw":"Please specify at least one valid keyword.","sub_limit":f"Max {MAX_SUBS} keywords.",
      "already":"You are already registered.","subscribed":"Subscribed to: {added}.","none_added":"Nothing added.",
@@ -28,44 +31,50 @@ UI={"welcome":"Welcome! Use /subscribe <kw> … /help","help":"/start /subscribe
 load_dotenv()
 BOT_TOKEN,OPENAI_API_KEY=os.getenv("BOT_TOKEN"),os.getenv("OPENAI_API_KEY")
 if not BOT_TOKEN or not OPENAI_API_KEY:raise RuntimeError
-openai.api_key=OPENAI_API_KEY
-os.makedirs(LOG_DIR,exist_ok=True);os.makedirs(CACHE_DIR,exist_ok=True)
-cut=datetime.now(UTC)-timedelta(days=30)
-for f in os.scandir(CACHE_DIR):
-    if f.is_file() and datetime.fromtimestamp(f.stat().st_mtime,UTC)<cut:os.unlink(f.path)
+os.makedirs(LOG_DIR,exist_ok=True)
 
 mask=lambda cid:hashlib.sha1(str(cid).encode()).hexdigest()[:6]
 logger=logging.getLogger("tb");logger.setLevel(logging.INFO)
 fh=RotatingFileHandler(os.path.join(LOG_DIR,"bot.log"),5_242_880,2)
 fh.setFormatter(logging.Formatter("%(asctime)s %(levelname)s: %(message)s"));logger.addHandler(fh);logger.addHandler(logging.StreamHandler())
 
-_conn:sqlite3.Connection|None=None
+_conn:aiosqlite.Connection|None=None
 _db_lock=asyncio.Lock()
-def conn_get()->sqlite3.Connection:
+async def conn_get()->aiosqlite.Connection:
     global _conn
     if _conn is None:
-        _conn=sqlite3.connect(DB_FILE,check_same_thread=False,timeout=30)
-        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn=await aiosqlite.connect(DB_FILE,isolation_level=None)
+        await _conn.executescript("PRAGMA journal_mode=WAL;PRAGMA synchronous=NORMAL;PRAGMA temp_store=MEMORY;PRAGMA cache_size=-65536;"
+                                  "PRAGMA mmap_size=268435456;PRAGMA busy_timeout=5000;PRAGMA wal_autocheckpoint=1000;")
     return _conn
-@contextmanager
-def cx()->Iterable[sqlite3.Connection]:
-    c=conn_get()
-    try:yield c
-    finally:c.commit()
+@asynccontextmanager
+async def cx()->AsyncIterator[aiosqlite.Connection]:
+    async with _db_lock:
+        c=await conn_get();await c.execute("BEGIN")
+        try:yield c
+        except:await c.execute("ROLLBACK");raise
+        else:await c.execute("COMMIT")
 async def db_exec(sql:str,params:Sequence[Any]|None=None)->int:
     async with _db_lock:
-        with cx() as c:
-            cur=c.execute(sql,params or ());return cur.rowcount
+        async with (await conn_get()).execute(sql,params or ()) as cur:return cur.rowcount
 async def db_query(sql:str,params:Sequence[Any]|None=None)->list[tuple]:
-    async with _db_lock:
-        with cx() as c:return c.execute(sql,params or ()).fetchall()
+    return list(await (await conn_get()).execute_fetchall(sql,params or ()))
+def iso_ts(s:str|None)->int:
+    try:return int(dtparse.isoparse(s).timestamp()) if s else 0
+    except ValueError:return 0
 async def init_db():
     await db_exec("CREATE TABLE IF NOT EXISTS users (chat_id INTEGER PRIMARY KEY, joined_at TEXT)")
-    await db_exec("CREATE TABLE IF NOT EXISTS subs (chat_id INTEGER,keyword TEXT,last_seen TEXT,PRIMARY KEY(chat_id,keyword))")
+    await db_exec("CREATE TABLE IF NOT EXISTS subs (chat_id INTEGER,keyword TEXT,last_seen TEXT,last_seen_ts INTEGER NOT NULL DEFAULT 0,PRIMARY KEY(chat_id,keyword))")
+    if "last_seen_ts" not in {r[1] for r in await db_query("PRAGMA table_info(subs)")}:
+        await db_exec("ALTER TABLE subs ADD COLUMN last_seen_ts INTEGER NOT NULL DEFAULT 0")
+        rows=await db_query("SELECT chat_id,keyword,last_seen FROM subs")
+        async with cx() as c:
+            await c.executemany("UPDATE subs SET last_seen_ts=? WHERE chat_id=? AND keyword=?",[(iso_ts(l),cid,kw) for cid,kw,l in rows])
     await db_exec("CREATE TABLE IF NOT EXISTS feedback (chat_id INTEGER,tender_id TEXT,feedback TEXT,timestamp TEXT)")
     await db_exec("CREATE TABLE IF NOT EXISTS sent (chat_id INTEGER,tender_id TEXT,PRIMARY KEY(chat_id,tender_id))")
+    await db_exec("CREATE TABLE IF NOT EXISTS summaries (hash TEXT PRIMARY KEY,summary TEXT,ts INTEGER)")
+    await db_exec("CREATE INDEX IF NOT EXISTS summaries_ts ON summaries(ts)")
 
-_regex_cache:dict[str,re.Pattern[str]]={}
 def parse_keywords(raw:str)->list[str]:
     out=[]
     for seg in re.split(r"[\s,]+",raw):
@@ -74,60 +83,94 @@ def parse_keywords(raw:str)->list[str]:
         if not VALID_KEYWORD.fullmatch(kw):logger.warning(UI["kw_invalid"].format(kw=kw));continue
         out.append(kw)
     return out
-def kw_match(txt:str,kw:str)->bool:
-    pat=_regex_cache.get(kw)
-    if pat is None:pat=_regex_cache.setdefault(kw,BOUND(kw))
-    return bool(pat.search(txt))
+def kw_automaton(kws:Iterable[str])->ahocorasick.Automaton:
+    A=ahocorasick.Automaton()
+    for kw in kws:A.add_word(kw.lower(),kw)
+    A.make_automaton();return A
+def kw_hits(blob:str,A:ahocorasick.Automaton)->set[str]:
+    n=len(blob);hits=set()
+    for end,kw in A.iter(blob):
+        start=end-len(kw)+1
+        if (start==0 or blob[start-1] not in WORD_CH) and (end+1==n or blob[end+1] not in WORD_CH):hits.add(kw)
+    return hits
 
+_http:aiohttp.ClientSession|None=None
+_etag:str|None=None
+_last_mod:str|None=None
+def http_get()->aiohttp.ClientSession:
+    global _http
+    if _http is None or _http.closed:
+        _http=aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10),headers={"User-Agent":"TenderBot/3.0"},
+                                    connector=aiohttp.TCPConnector(ssl=ssl.create_default_context(cafile=certifi.where())))
+    return _http
 async def fetch_feed()->list[dict[str,Any]]:
+    global _etag,_last_mod
+    hdrs={k:v for k,v in (("If-None-Match",_etag),("If-Modified-Since",_last_mod)) if v}
     for att in range(1,HTTP_RETRIES+1):
         try:
-            resp=await asyncio.get_running_loop().run_in_executor(None,partial(requests.get,FEED_URL,timeout=10,headers={"User-Agent":"TenderBot/3.0"},verify=certifi.where()))
-            resp.raise_for_status();break
+            async with http_get().get(FEED_URL,headers=hdrs) as r:
+                r.raise_for_status();status,rh,body=r.status,r.headers,await r.read()
+            break
         except Exception:
             if att==HTTP_RETRIES:logger.exception("RSS fail");raise
             await asyncio.sleep(HTTP_BACKOFF*2**(att-1))
-    feed=feedparser.parse(resp.text)
-    return[{"id":e.get("id")or e.get("link"),"title":e.get("title","").strip(),"link":e.get("link"),
-            "summary":BeautifulSoup(e.get("summary",""),"html.parser").get_text(),
-            "published":e.get("published"),"updated":e.get("updated")}for e in feed.entries]
+    if status==304:logger.debug("RSS not modified");return[]
+    _etag,_last_mod=rh.get("ETag"),rh.get("Last-Modified")
+    feed=fastfeedparser.parse(body)
+    out=[]
+    for e in feed.entries:
+        t,sm=(e.get("title")or"").strip(),html.unescape(STRIP_HTML.sub("",e.get("summary")or e.get("description")or""))
+        ts=e.get("updated")or e.get("published")
+        try:ets=int(dtparse.parse(ts).timestamp()) if ts else None
+        except:ets=int(datetime.now(UTC).timestamp())
+        out.append({"id":e.get("id")or e.get("link"),"title":t,"link":e.get("link"),"summary":sm,
+                    "published":e.get("published"),"updated":e.get("updated"),"_match":f"{t}\n{sm}".lower(),"_ts":ets})
+    return out
 
-_openai_calls:list[datetime]=[]
+_openai_calls:deque[float]=deque()
+_openai_lock=asyncio.Lock()
 async def rate_limit():
-    now=datetime.now(UTC);_openai_calls.append(now)
-    while _openai_calls and (now-_openai_calls[0]).total_seconds()>60:_openai_calls.pop(0)
-    if len(_openai_calls)>=OPENAI_LIMIT:
-        delay=61-(now-_openai_calls[0]).total_seconds()
-        logger.info("OpenAI sleep %.1f",delay);await asyncio.sleep(delay)
-def cache_p(t:str)->str:return os.path.join(CACHE_DIR,hashlib.sha256(t.encode()).hexdigest()+".txt")
+    async with _openai_lock:
+        while True:
+            now=time.monotonic()
+            while _openai_calls and now-_openai_calls[0]>60:_openai_calls.popleft()
+            if len(_openai_calls)<OPENAI_LIMIT:break
+            delay=61-(now-_openai_calls[0])
+            logger.info("OpenAI sleep %.1f",delay);await asyncio.sleep(delay)
+        _openai_calls.append(now)
+_openai_sem=asyncio.Semaphore(OPENAI_CONCURRENCY)
+async def purge_cache_job(_:ContextTypes.DEFAULT_TYPE):
+    await db_exec("DELETE FROM summaries WHERE ts<CAST(strftime('%s','now','-30 days') AS INTEGER)")
 async def summarise(raw:str)->str:
-    sn=raw.strip()[:1500];cp=cache_p(sn)
-    if os.path.exists(cp):
-        with open(cp,"r",encoding="utf-8")as f:return f.read()
-    for at in range(1,OPENAI_RETRIES+1):
-        try:
-            await rate_limit()
-            res=await asyncio.get_running_loop().run_in_executor(None,partial(openai.ChatCompletion.create,model="gpt-4o",timeout=15,messages=[{"role":"system","content":"Summarise in max 60 words."},{"role":"user","content":sn}]))
-            sm=res.choices[0].message.content.strip();break
-        except Exception:
-            if at==OPENAI_RETRIES:sm="[⚠️ Summary unavailable] "+textwrap.shorten(sn,120)
-            else:await asyncio.sleep(2*at)
-    with open(cp,"w",encoding="utf-8")as f:f.write(sm)
+    sn=raw.strip()[:1500];h=hashlib.sha256(sn.encode()).hexdigest()
+    if row:=await db_query("SELECT summary FROM summaries WHERE hash=?",(h,)):return row[0][0]
+    async with _openai_sem:
+        for at in range(1,OPENAI_RETRIES+1):
+            try:
+                await rate_limit()
+                body=orjson.dumps({"model":"gpt-4o","messages":[{"role":"system","content":"Summarise in max 60 words."},{"role":"user","content":sn}]})
+                async with http_get().post(OPENAI_URL,data=body,timeout=aiohttp.ClientTimeout(total=15),
+                                           headers={"Authorization":f"Bearer {OPENAI_API_KEY}","Content-Type":"application/json"}) as r:
+                    r.raise_for_status();res=orjson.loads(await r.read())
+                sm=res["choices"][0]["message"]["content"].strip();break
+            except Exception:
+                if at==OPENAI_RETRIES:sm="[⚠️ Summary unavailable] "+textwrap.shorten(sn,120)
+                else:await asyncio.sleep(2*at)
+    await db_exec("INSERT OR REPLACE INTO summaries VALUES (?,?,?)",(h,sm,int(time.time())))
     return sm
 
-def build_msg(e:dict[str,Any],summary:str,kw:str,upd:bool)->str:
-    t=e["title"]+(" (Updated)" if upd else "")
-    body="\n".join([f"📝 <b>{html.escape(t)}</b>",html.escape(summary),f"🔍 <code>{html.escape(kw)}</code>"])
-    link=f"🔗 <a href='{html.escape(e['link'])}'>View tender</a>"
-    return f"{body}\n\n{link}"
+def build_msg(e:dict[str,Any],summary:str,kw_html:str,upd:bool)->str:
+    return (f"📝 <b>{e['_title_html']}{' (Updated)' if upd else ''}</b>\n{html.escape(summary)}\n🔍 <code>{kw_html}</code>"
+            f"\n\n🔗 <a href='{e['_link_html']}'>View tender</a>")
 def split_html(txt:str)->list[str]:
     if len(txt)<=MSG_MAX:return[txt]
-    parts=[]
-    while len(txt)>MSG_MAX:
-        cut=max(txt.rfind("\n\n",0,MSG_MAX),txt.rfind("<p",0,MSG_MAX))
-        if cut<=0:cut=MSG_MAX
-        parts.append(txt[:cut]);txt=txt[cut:].lstrip()
-    parts.append(txt);return parts
+    offs=[m.start() for m in BREAK_RE.finditer(txt)];parts=[];i=0;n=len(txt)
+    while n-i>MSG_MAX:
+        j=bisect_right(offs,i+MSG_MAX-2)-1
+        cut=offs[j] if j>=0 and offs[j]>i else i+MSG_MAX
+        parts.append(txt[i:cut]);i=cut
+        while i<n and txt[i].isspace():i+=1
+    parts.append(txt[i:]);return parts
 async def send_split(ctx:ContextTypes.DEFAULT_TYPE,cid:int,txt:str,mark:InlineKeyboardMarkup|None):
     for i,ch in enumerate(split_html(txt)):
         await ctx.bot.send_message(cid,ch,parse_mode=ParseMode.HTML,reply_markup=mark if i==0 else None,disable_web_page_preview=True)
@@ -148,7 +191,7 @@ async def cmd_subscribe(u:Update,_):
     for kw in kws:
         if len(cur)+len(added)>=MAX_SUBS:break
         if kw not in cur:
-            await db_exec("INSERT INTO subs VALUES (?,?,?)",(cid,kw,"1970-01-01T00:00:00Z"));added.append(kw)
+            await db_exec("INSERT INTO subs (chat_id,keyword,last_seen) VALUES (?,?,?)",(cid,kw,"1970-01-01T00:00:00Z"));added.append(kw)
     await u.message.reply_text(UI["subscribed" if added else "none_added"].format(added=", ".join(added)))
 async def cmd_unsubscribe(u:Update,_):
     cid=u.effective_chat.id;kws=parse_keywords(" ".join(u.message.text.split()[1:]))
@@ -177,35 +220,53 @@ async def cb_buttons(u:Update,_):
 async def scan_feed_job(ctx:ContextTypes.DEFAULT_TYPE):
     if ctx.job.data.get("running"):return
     ctx.job.data["running"]=True
+    sent_rows:list[tuple[int,str]]=[];seen_updates:dict[tuple[int,str],int]={}
     try:
-        entries=await fetch_feed()
-        sent={(r[0],r[1]) for r in await db_query("SELECT chat_id,tender_id FROM sent")}
-        subs=await db_query("SELECT chat_id,keyword,last_seen FROM subs")
-        for cid,kw,last in subs:
-            threshold=dtparse.isoparse(last).astimezone(UTC)
-            for e in entries:
-                if not kw_match(e["title"],kw) and not kw_match(e["summary"],kw):continue
-                ts=e["updated"] or e["published"]
-                if not ts:continue
-                try:edt=dtparse.parse(ts).astimezone(UTC)
-                except:edt=datetime.now(UTC)
-                if edt<=threshold or (cid,e["id"]) in sent:continue
-                summ=await summarise(e["summary"])
-                msg=build_msg(e,summ,kw,bool(e["updated"]))
-                kb=InlineKeyboardMarkup([[InlineKeyboardButton("✅ Relevant",callback_data=f"suit:{e['id']}"),
-                                           InlineKeyboardButton("❌ Irrelevant",callback_data=f"unsuit:{e['id']}")]])
-                try:
-                    await send_split(ctx,cid,msg,kb)
-                    try:await db_exec("INSERT INTO sent VALUES (?,?)",(cid,e["id"]))
-                    except sqlite3.IntegrityError:logger.debug("dup %s %s",mask(cid),e["id"])
-                    await db_exec("UPDATE subs SET last_seen=? WHERE chat_id=? AND keyword=?",(edt.isoformat(timespec="seconds")+"Z",cid,kw))
-                except:logger.exception("send %s %s",mask(cid),e["id"])
+        subs=await db_query("SELECT chat_id,keyword,last_seen_ts FROM subs")
+        if not subs:return
+        cutoff=min(t for _,_,t in subs)
+        entries=sorted((e for e in await fetch_feed() if e["_ts"] is not None and e["_ts"]>cutoff),key=lambda e:-e["_ts"])
+        A=kw_automaton({kw for _,kw,_ in subs})
+        hit_entries=[(e,eh) for e in entries if (eh:=kw_hits(e["_match"],A))]
+        if not hit_entries:return
+        for e,_ in hit_entries:e["_title_html"],e["_link_html"]=html.escape(e["title"]),html.escape(e["link"] or "")
+        sent_by_cid:dict[int,set[str]]={}
+        for cid,tid in await db_query("SELECT chat_id,tender_id FROM sent WHERE chat_id IN (SELECT DISTINCT chat_id FROM subs)"):
+            sent_by_cid.setdefault(cid,set()).add(tid)
+        matches:list[tuple[int,str,str,dict[str,Any]]]=[]
+        for cid,kw,threshold in subs:
+            kw_html=html.escape(kw)
+            for e,eh in hit_entries:
+                if e["_ts"]<=threshold:break
+                if kw not in eh or e["id"] in sent_by_cid.get(cid,()):continue
+                sent_by_cid.setdefault(cid,set()).add(e["id"]);matches.append((cid,kw,kw_html,e))
+        texts=list({e["summary"]:None for _,_,_,e in matches})
+        summaries=dict(zip(texts,await asyncio.gather(*map(summarise,texts))))
+        for cid,kw,kw_html,e in matches:
+            msg=build_msg(e,summaries[e["summary"]],kw_html,bool(e["updated"]))
+            kb=InlineKeyboardMarkup([[InlineKeyboardButton("✅ Relevant",callback_data=f"suit:{e['id']}"),
+                                       InlineKeyboardButton("❌ Irrelevant",callback_data=f"unsuit:{e['id']}")]])
+            try:
+                await send_split(ctx,cid,msg,kb)
+                sent_rows.append((cid,e["id"]))
+                seen_updates[(cid,kw)]=max(e["_ts"],seen_updates.get((cid,kw),0))
+            except:logger.exception("send %s %s",mask(cid),e["id"])
     finally:
-        ctx.job.data["running"]=False
+        try:
+            if sent_rows or seen_updates:
+                async with cx() as c:
+                    await c.executemany("INSERT OR IGNORE INTO sent VALUES (?,?)",sent_rows)
+                    await c.executemany("UPDATE subs SET last_seen=?,last_seen_ts=? WHERE chat_id=? AND keyword=?",
+                                        [(datetime.fromtimestamp(ts,UTC).strftime("%Y-%m-%dT%H:%M:%SZ"),ts,cid,kw) for (cid,kw),ts in seen_updates.items()])
+        finally:ctx.job.data["running"]=False
+
+async def on_shutdown(_):
+    if _http is not None:await _http.close()
+    if _conn is not None:await _conn.close()
 
 async def main():
     await init_db()
-    app=ApplicationBuilder().token(BOT_TOKEN).rate_limiter(AIORateLimiter()).build()
+    app=ApplicationBuilder().token(BOT_TOKEN).rate_limiter(AIORateLimiter()).post_shutdown(on_shutdown).build()
     app.add_handler(CommandHandler("start",cmd_start))
     app.add_handler(CommandHandler("help",cmd_help))
     app.add_handler(CommandHandler("subscribe",cmd_subscribe))
@@ -213,6 +274,7 @@ async def main():
     app.add_handler(CommandHandler("list",cmd_list))
     app.add_handler(CommandHandler("clear",cmd_clear))
     app.add_handler(CallbackQueryHandler(cb_buttons))
+    app.job_queue.run_repeating(purge_cache_job,interval=3600,first=0)
     app.job_queue.run_repeating(scan_feed_job,interval=FETCH_MIN*60,first=5,coalesce=True,data={"running":False})
     logger.info("Bot started");await app.run_polling()
 